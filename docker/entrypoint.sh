@@ -81,6 +81,11 @@ then
 	set -- "$@" --webpath "$WEBPATH"
 fi
 
+if [ "X$POLL_INTERVAL" != "X" ]
+then
+	set -- "$@" --poll-interval "$POLL_INTERVAL"
+fi
+
 set -- "$@" "$REMOTE" "$HOST" "$DIRIGERA_TOKEN"
 
 if [ "$UNSAFE_DEVELOPMENT_MODE" = "This is UNSAFE and I want to make this server more vulnerable, PLease, TrUST me, I reALly reaLLY wanT to Be haCKed!" ]
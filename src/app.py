@@ -3,18 +3,25 @@
 accessories managed by a Dirigera hub to Prometheus.
 """
 import argparse
+import collections
 import dataclasses
 import datetime
 import enum
 import logging
+import math
+import operator
+import os
 import pathlib
+import re
 import secrets
 import string
 import sys
 import textwrap
 import threading
+import time
+import types
 import typing
-from functools import cache
+from functools import lru_cache
 from typing import Callable
 
 import dirigera
@@ -32,7 +39,7 @@ import dirigera.devices.scene
 import dirigera.devices.water_sensor
 import dirigera.hub.hub
 import requests
-from flask import Flask, Blueprint, request, Response, abort
+from flask import Flask, Blueprint, Response
 from prometheus_client import make_wsgi_app, Counter, Gauge, Info, Histogram, CollectorRegistry
 from prometheus_client.metrics import MetricWrapperBase, Enum, Summary
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
@@ -43,62 +50,72 @@ APP_DIR = pathlib.Path(__file__).absolute().parent
 DEFAULT_ADDRESS = '0.0.0.0'  # nosec: disable=104
 DEFAULT_PORT = 8080
 DEFAULT_PROTO = 'http'
+DEFAULT_POLL_INTERVAL = 15
+# Number of consecutive failed polls after which /metrics answers with an error
+MAX_FAILED_POLLS = 3
+GRAVEYARD_SIZE = 64
 CONFIG = {}
+_UPPER_TO_SNAKE = str.maketrans({c: '_' + c.lower() for c in string.ascii_uppercase})
+_NON_SNAKE_RE = re.compile(r'[^a-z0-9_]')
+# Lowercased models for which the underlying lib may return several devices with the same name
+_SAME_NAME_MODELS = frozenset({'bilresa'})
 
 bp = Blueprint('app', __name__)
 
-@bp.before_request
-def force_hostname():
-    """Force the usage of the right hostname"""
-    if request.host != CONFIG['HOSTNAME']:
-        logging.warning("Just seen a request asking for '%s', expecting the hostname '%s'",
-                        request.host, CONFIG['HOSTNAME'])
-        abort(404)
+_SECURITY_HEADERS: tuple[tuple[str, str], ...] = (
+    ('Content-Security-Policy', "default-src 'none'; "
+                                "base-uri 'none'; "
+                                "sandbox ; "
+                                "form-action 'none'; "
+                                "frame-ancestors 'none'; "
+                                "upgrade-insecure-requests; "
+                                "require-trusted-types-for 'script'; "
+                                "trusted-types 'none'"),
+    ('X-Content-Type-Options', 'nosniff'),
+    ('Referer', 'no-referrer'),
+    ('Permissions-Policy', 'accelerometer=(), ambient-light-sensor=(), autoplay=(), '
+                           'battery=(), camera=(), display-capture=(), document-domain=(), '
+                           'encrypted-media=(), execution-while-not-rendered=(), '
+                           'execution-while-out-of-viewport=(), fullscreen=(), gamepad=(), '
+                           'geolocation=(), gyroscope=(), hid=(), identity-credentials-get=(), '
+                           'idle-detection=(), local-fonts=(), magnetometer=(), microphone=(), '
+                           'midi=(), payment=(), picture-in-picture=(), '
+                           'publickey-credentials-create=(), publickey-credentials-get=(), '
+                           'screen-wake-lock=(), serial=(), speaker-selection=(), '
+                           'storage-access=(), usb=(), web-share=(), xr-spatial-tracking=()'),
+)
 
-@bp.after_request
 def security_headers(response: Response) -> Response:
     """Setup some security headers if not already present"""
-    # pylint: disable=line-too-long
-    headers = {
-        'Content-Security-Policy': "default-src 'none'; "
-                                   "base-uri 'none'; "
-                                   "sandbox ; "
-                                   "form-action 'none'; "
-                                   "frame-ancestors 'none'; "
-                                   "upgrade-insecure-requests; "
-                                   "require-trusted-types-for 'script'; "
-                                   "trusted-types 'none'",
-        'X-Content-Type-Options': 'nosniff',
-        'Referer': 'no-referrer',
-        'Permissions-Policy': 'accelerometer=(), ambient-light-sensor=(), autoplay=(), '
-                              'battery=(), camera=(), display-capture=(), document-domain=(), '
-                              'encrypted-media=(), execution-while-not-rendered=(), '
-                              'execution-while-out-of-viewport=(), fullscreen=(), gamepad=(), '
-                              'geolocation=(), gyroscope=(), hid=(), identity-credentials-get=(), '
-                              'idle-detection=(), local-fonts=(), magnetometer=(), microphone=(), '
-                              'midi=(), payment=(), picture-in-picture=(), '
-                              'publickey-credentials-create=(), publickey-credentials-get=(), '
-                              'screen-wake-lock=(), serial=(), speaker-selection=(), '
-                              'storage-access=(), usb=(), web-share=(), xr-spatial-tracking=()'
-    }
-    for h_name, h_value in headers.items():
-        if response.headers.get(h_name) is None:
-            response.headers[h_name] = h_value
+    resp_headers = response.headers
+    for h_name, h_value in _SECURITY_HEADERS:
+        resp_headers.setdefault(h_name, h_value)
     return response
 
+_ROBOTS_BODY = textwrap.dedent(
+    # pylint: disable=line-too-long
+    '''\
+    # Stop all search engines from crawling this site
+    User-agent: *
+    Disallow: /
+    '''
+).encode('utf-8')
+
+_SECURITY_BODY = textwrap.dedent(
+    # pylint: disable=line-too-long
+    '''\
+    Contact: https://github.com/ajabep/dirigera-prometheus/blob/main/SECURITY.md
+    Expires: 2025-12-31T23:00:00.000Z
+    Acknowledgments: https://github.com/ajabep/dirigera-prometheus/blob/main/SECURITY.md#hall-of-fame
+    Preferred-Languages: en, fr
+    '''
+).encode('utf-8')
+
 @bp.get("/robots.txt")
 def robotstxt():
     """Robots.txt handler/generator"""
-    logging.debug("ROBOTS: Thread ident = %r", threading.get_ident())
     return Response(
-        textwrap.dedent(
-            # pylint: disable=line-too-long
-            '''\
-            # Stop all search engines from crawling this site
-            User-agent: *
-            Disallow: /
-            '''
-        ),
+        _ROBOTS_BODY,
         mimetype='text/plain',
         content_type='text/plain; charset=utf-8'
     )
@@ -107,21 +124,51 @@ def robotstxt():
 def securitytxt():
     """Security.txt handler/generator"""
     return Response(
-        textwrap.dedent(
-            # pylint: disable=line-too-long
-            '''\
-            Contact: https://github.com/ajabep/dirigera-prometheus/blob/main/SECURITY.md
-            Expires: 2025-12-31T23:00:00.000Z
-            Acknowledgments: https://github.com/ajabep/dirigera-prometheus/blob/main/SECURITY.md#hall-of-fame
-            Preferred-Languages: en, fr
-            '''
-        ),
+        _SECURITY_BODY,
         mimetype='text/plain',
         content_type='text/plain; charset=utf-8'
     )
 
+class KeepAliveHub(dirigera.Hub):
+    """dirigera.Hub opens a new connection, thus a new TLS handshake, for each request. This one
+    reuses a single pooled session per process."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session: typing.Optional[requests.Session] = None
+        self.session_pid = None
+        self.snapshot = threading.local()
+
+    def get_session(self) -> requests.Session:
+        """The pooled connections must not be shared with a forked process (e.g. gunicorn --preload),
+        thus each process opens its own session."""
+        pid = os.getpid()
+        if self.session_pid != pid:
+            session = requests.Session()
+            session.headers.update(self.headers())
+            session.verify = False  # nosec: disable=501 The hub uses a self-signed certificate
+            self.session = session
+            self.session_pid = pid
+        return self.session
+
+    def get(self, route: str) -> typing.Any:
+        if route == '/devices' and getattr(self.snapshot, 'devices', None) is not None:
+            return self.snapshot.devices
+        response = self.get_session().get(f"{self.api_base_url}{route}", timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+    def get_all_devices(self) -> list[dirigera.devices.device.Device]:
+        """dirigera.Hub fetches the whole device list once per kind of device. Fetch it once, and let
+        every kind filter the same snapshot."""
+        self.snapshot.devices = self.get('/devices')
+        try:
+            return super().get_all_devices()
+        finally:
+            self.snapshot.devices = None
+
+@lru_cache(maxsize=1)
 def get_hub() -> dirigera.Hub:
-    return dirigera.Hub(
+    return KeepAliveHub(
         token=CONFIG['TOKEN'],
         ip_address=CONFIG['REMOTE_ADDR']
     )
@@ -130,19 +177,21 @@ def test_hub_params() -> None:
     hub = get_hub()
     hub.get_scenes()
 
+@lru_cache(maxsize=4096)
 def snakecase(s: str) -> str:
-    return ''.join([
-        c if c in string.ascii_lowercase + string.digits else '_' + c.lower() if c in string.ascii_uppercase else '_'
-        for c in s
-    ]).strip('_').replace('__', '_')
+    # Each other character becomes a single '_', and only one doubled '_' is collapsed: this is how the
+    # metrics have always been named, changing it would rename the exported metrics.
+    return _NON_SNAKE_RE.sub('_', s.translate(_UPPER_TO_SNAKE)).strip('_').replace('__', '_')
 
 T = typing.TypeVar('T')
+_STR_CONVERTERS: dict[type, Callable[[str], typing.Any]] = {
+    bool: lambda v: v.lower() in ('true', 't', 'yes', 'y'),
+    datetime.datetime: datetime.datetime.fromisoformat,
+    datetime.time: datetime.time.fromisoformat,
+    datetime.date: datetime.date.fromisoformat,
+}
 def str_to_type(value: str, dest_type: type[T]) -> T:
-    if dest_type == bool:
-        return value.lower() in ['true', 't', 'yes', 'y']
-    if dest_type in [datetime.datetime, datetime.time, datetime.date]:
-        dest_type = dest_type.fromisoformat
-    return dest_type(value)
+    return _STR_CONVERTERS.get(dest_type, dest_type)(value)
 
 def any_to_type(value: typing.Any, dest_type: type[T]) -> T:
     if isinstance(value, dest_type):
@@ -151,11 +200,61 @@ def any_to_type(value: typing.Any, dest_type: type[T]) -> T:
         value = str(value)
     return str_to_type(value, dest_type)
 
-@dataclasses.dataclass
-class DeviceMetric:
+_DEFAULT_ATTR_KEYS = frozenset(dirigera.devices.device.Attributes.model_fields.keys())
+
+# How autofill() pushes a value into a metric, see DeviceMetric.metric_tag()
+_TAG_GAUGE = 0
+_TAG_INFO = 1
+_TAG_ENUM = 2
+_TAG_OBSERVE = 3
+_UNSET = object()
+
+@lru_cache(maxsize=64)
+def _metric_template_for(attr_cls: type[dirigera.devices.device.Attributes]) -> tuple[tuple[str, type[MetricWrapperBase], dict[str, typing.Any]], ...]:
+    """The (attribute name, metric class, extra metric arguments) to create for each field specific to
+    an attributes class, i.e. not in the common Attributes model. Depends only on the class, so all
+    the devices of the same kind share the result."""
+    my_fields = attr_cls.model_fields
+    template = []
+    for attr_name in my_fields.keys() - _DEFAULT_ATTR_KEYS:
+        f_type = my_fields[attr_name].annotation
+        # Unwrap Optional[X] (whatever the order of the Union members) into X
+        if typing.get_origin(f_type) in (typing.Union, types.UnionType):
+            f_type = next(a for a in typing.get_args(f_type) if a is not types.NoneType)
+
+        if f_type in [int, float]:
+            template.append((attr_name, Gauge, {}))
+        elif issubclass(f_type, enum.Enum):
+            template.append((attr_name, Enum, {'states': [str(e) for e in f_type]}))
+        elif f_type == bool:
+            template.append((attr_name, Enum, {'states': ['False', 'True']}))
+        elif f_type in [str, datetime.time, datetime.datetime]:
+            template.append((attr_name, Info, {}))
+        else:
+            raise NotImplementedError(f'Cannot handle field type {f_type}')
+    return tuple(template)
+
+def _tuple_attrgetter(names: tuple[str, ...]) -> Callable[[typing.Any], tuple]:
+    """operator.attrgetter() always returning a tuple, whatever the number of names"""
+    if not names:
+        return lambda obj: ()
+    if len(names) == 1:
+        getter = operator.attrgetter(names[0])
+        return lambda obj: (getter(obj),)
+    return operator.attrgetter(*names)
+
+@dataclasses.dataclass(slots=True)
+class DeviceMetric:  # pylint: disable=too-many-instance-attributes
     attributes: Info = dataclasses.field(init=False)
     values: dict[str, MetricWrapperBase] = dataclasses.field(default_factory=dict, init=False)
     dev: dirigera.devices.device.Device
+    registry: CollectorRegistry = dataclasses.field(init=False)
+    _name: typing.Optional[str] = dataclasses.field(init=False)
+    _static_info: dict[str, str] = dataclasses.field(init=False)
+    _last_dynamic_info: typing.Optional[dict[str, str]] = dataclasses.field(init=False)
+    _last_values: dict[str, typing.Any] = dataclasses.field(init=False)
+    _attr_plan: list[tuple[int, str, MetricWrapperBase]] = dataclasses.field(init=False)
+    _attr_values: Callable[[typing.Any], tuple] = dataclasses.field(init=False)
 
     def __eq__(self, other) -> bool:
         return self.dev.id == other.dev.id
@@ -163,58 +262,56 @@ class DeviceMetric:
     def __hash__(self) -> int:
         return hash(self.dev.id)
 
-    @cache  # pylint: disable=method-cache-max-size-none
-    def get_own_attributes(self) -> dict[str, object]:
-        my_fields = self.dev.attributes.model_fields
-        attrs = set(my_fields.keys())
-        default_attrs = set(dirigera.devices.device.Attributes.model_fields.keys())
-        return {
-            k: my_fields[k]
-            for k in attrs - default_attrs
-        }
-
     def __init__(self, dev: dirigera.devices.device.Device, registry: CollectorRegistry):
-        logging.info('Init a DeviceMetric with %r', dev)
+        logging.info('Init a DeviceMetric for the %s %s', dev.device_type, dev.id)
+        logging.debug('Device: %r', dev)
         self.dev = dev
-        logging.debug('name=%s', self.name)
+        self._name = None
+        name = self.name
+        logging.debug('name=%s', name)
         dev_id = dev.id
         dev_type = dev.device_type
         self.registry = registry
-        self.attributes = Info(self.name + '_attributes',
-                               f'Accessory named "{self.name}", id "{dev_id}"',
+        self.attributes = Info(name + '_attributes',
+                               f'Accessory named "{name}", id "{dev_id}"',
                                registry=self.registry)
         self.values = {}
 
-        for attr_name, field_info in self.get_own_attributes().items():
-            f_type = field_info.annotation
-
-            if isinstance(f_type, type(typing.Optional[str])) and f_type.__origin__ == typing.Union:
-                if f_type.__args__[0] is not None:
-                    f_type = f_type.__args__[0]
-                else:
-                    f_type = f_type.__args__[0]
-
-            if f_type in [int, float]:
-                self.values[attr_name] = Gauge(self.name + '_' + attr_name, f'Values related to the {dev_type} accessory {self.name} ({dev_id})', registry=self.registry)
-            elif issubclass(f_type, enum.Enum):
-                self.values[attr_name] = Enum(self.name + '_' + attr_name, f'Values related to the {dev_type} accessory {self.name} ({dev_id})',
-                                              states=[
-                                                  str(e)
-                                                  for e in f_type
-                                              ],
-                                              registry=self.registry)
-            elif f_type == bool:
-                self.values[attr_name] = Enum(self.name + '_' + attr_name, f'Values related to the {dev_type} accessory {self.name} ({dev_id})',
-                                              states=['False', 'True'], registry=self.registry)
-            elif f_type in [str, datetime.time, datetime.datetime]:
-                self.values[attr_name] = Info(self.name + '_' + attr_name, f'Values related to the {dev_type} accessory {self.name} ({dev_id})', registry=self.registry)
-            else:
-                raise NotImplementedError(f'Cannot handle field type {f_type}')
-
+        prefix = name + '_'
+        help_str = f'Values related to the {dev_type} accessory {name} ({dev_id})'
+        for attr_name, metric_cls, kwargs in _metric_template_for(type(dev.attributes)):
+            self.values[attr_name] = metric_cls(prefix + attr_name, help_str, registry=self.registry, **kwargs)
+
+        self._static_info = self.to_dict_str({
+            'id': dev_id,
+            'relation_id': dev.relation_id,
+            'type': dev.type,
+            'device_type': dev_type,
+            'model': dev.attributes.model,
+            'manufacturer': dev.attributes.manufacturer,
+            'serial_number': dev.attributes.serial_number,
+            'product_code': dev.attributes.product_code,
+        })
+        self._last_dynamic_info = None
+        self._last_values = {}
+        self._attr_plan = [
+            (self.metric_tag(value_obj), attr_name, value_obj)
+            for attr_name, value_obj in self.values.items()
+        ]
+        self._attr_values = _tuple_attrgetter(tuple(self.values.keys()))
         self.autofill()
 
-    def __del__(self):
-        self.unregister()
+    def register(self):
+        """Register again the metrics of a device previously unregistered"""
+        collectors = [self.attributes, *self.values.values()]
+        for i, collector in enumerate(collectors):
+            try:
+                self.registry.register(collector)
+            except ValueError:
+                # Name already taken (e.g. by a new device): rollback
+                for registered in collectors[:i]:
+                    self.registry.unregister(registered)
+                raise
 
     def unregister(self):
         self.registry.unregister(self.attributes)
@@ -223,18 +320,26 @@ class DeviceMetric:
 
     @property
     def name(self) -> str:
-        room = self.dev.room
+        """Prefix of the metrics names. Computed once, as the metrics are registered at init"""
+        if self._name is None:
+            self._name = self.build_name(self.dev)
+        return self._name
+
+    @classmethod
+    def build_name(cls, dev: dirigera.devices.device.Device) -> str:
+        room = dev.room
         prefix = ''
         if room is not None:
             prefix = snakecase(room.name) + '_'
         suffix = ''
+        dev_model = dev.attributes.model.lower()
         if any(
-            model.lower() in self.dev.attributes.model.lower()
-            for model in ['BILRESA']
+            model in dev_model
+            for model in _SAME_NAME_MODELS
         ):
             # There is a bug in the underlying lib: it returns multiple times the same device with different id but the same name. The only way to differentiate them is the ID. So we add it to the name to avoid conflicts.
-            suffix = '_' + self.dev.id
-        return prefix + snakecase(self.dev.attributes.custom_name) + '_' + snakecase(self.dev.device_type) + suffix
+            suffix = '_' + dev.id
+        return prefix + snakecase(dev.attributes.custom_name) + '_' + snakecase(dev.device_type) + suffix
 
     @classmethod
     def to_str(cls, v: typing.Any) -> str:
@@ -247,12 +352,24 @@ class DeviceMetric:
             for k, v in d.items()
         }
 
+    @classmethod
+    def metric_tag(cls, value_obj: MetricWrapperBase) -> int:
+        """Select, once for all, how a value is pushed into the given prometheus metric"""
+        if isinstance(value_obj, Counter):
+            raise NotImplementedError(f'Cannot set a prometheus Counter without resetting it (value {value_obj})')
+        if isinstance(value_obj, Info):
+            return _TAG_INFO
+        if isinstance(value_obj, Gauge):
+            return _TAG_GAUGE
+        if isinstance(value_obj, Enum):
+            return _TAG_ENUM
+        if isinstance(value_obj, (Summary, Histogram)):
+            return _TAG_OBSERVE
+        raise NotImplementedError(f'Cannot handle prometheus metric {value_obj}')
+
     def autofill(self) -> None:
-        parameters = {
-            'id': self.dev.id,
-            'relation_id': self.dev.relation_id,
-            'type': self.dev.type,
-            'device_type': self.dev.device_type,
+        # Only the fields which may change during the device lifetime; the others are in _static_info
+        dynamic_info = self.to_dict_str({
             'is_reachable': self.dev.is_reachable,
             'remote_links': len(self.dev.remote_links),
             'is_hidden': self.dev.is_hidden,
@@ -260,44 +377,43 @@ class DeviceMetric:
             'capabilities_send': len(self.dev.capabilities.can_send),
 
             'custom_name': self.dev.attributes.custom_name,
-            'model': self.dev.attributes.model,
-            'manufacturer': self.dev.attributes.manufacturer,
             'firmware_version': self.dev.attributes.firmware_version,
-            'serial_number': self.dev.attributes.serial_number,
-            'product_code': self.dev.attributes.product_code,
             'ota_status': self.dev.attributes.ota_status,
             'ota_state': self.dev.attributes.ota_state,
             'ota_progress': self.dev.attributes.ota_progress,
             'ota_policy': self.dev.attributes.ota_policy,
             'ota_schedule_start':  self.dev.attributes.ota_schedule_start,
             'ota_schedule_end': self.dev.attributes.ota_schedule_end,
-        }
+        })
         if self.dev.room is not None:
-            parameters.update({
+            dynamic_info.update(self.to_dict_str({
                 'room_id': self.dev.room.id,
                 'room_name': self.dev.room.name,
                 'room_color': self.dev.room.color,
                 'room_icon': self.dev.room.icon,
-            })
-
-        self.attributes.info(self.to_dict_str(parameters))
-        for attr_name, _ in self.get_own_attributes().items():
-            value_obj = self.values[attr_name]
-            value_to_set = getattr(self.dev.attributes, attr_name)
-
-            if isinstance(value_obj, Counter):
-                raise NotImplementedError(f'Cannot set a prometheus Counter without resetting it (value {value_obj})')
-            if isinstance(value_obj, Info):
+            }))
+
+        if dynamic_info != self._last_dynamic_info:
+            self.attributes.info({**self._static_info, **dynamic_info})
+            self._last_dynamic_info = dynamic_info
+        attrs = self.dev.attributes
+        last_values = self._last_values
+        for (tag, attr_name, value_obj), value_to_set in zip(self._attr_plan, self._attr_values(attrs)):
+            if tag != _TAG_OBSERVE:
+                # Gauges, Infos and Enums hold a state: no need to set it again if it is unchanged
+                if last_values.get(attr_name, _UNSET) == value_to_set:
+                    continue
+                last_values[attr_name] = value_to_set
+            if tag == _TAG_INFO:
                 value_obj.info({'value': str(value_to_set)})
-            if isinstance(value_obj, Gauge):
-                if value_to_set is not None:
-                    value_obj.set(value_to_set)
-            if isinstance(value_obj, (Summary, Histogram)):
-                if value_to_set is not None:
-                    value_obj.observe(value_to_set)
-            if isinstance(value_obj, Enum):
-                if value_to_set is not None:
-                    value_obj.state(str(value_to_set))
+            elif value_to_set is None:
+                continue
+            elif tag == _TAG_GAUGE:
+                value_obj.set(value_to_set)
+            elif tag == _TAG_ENUM:
+                value_obj.state(str(value_to_set))
+            else:
+                value_obj.observe(value_to_set)
 
     def update(self, dev: dirigera.devices.device.Device):
         if self.dev.id != dev.id:
@@ -305,29 +421,80 @@ class DeviceMetric:
         self.dev = dev
         self.autofill()
 
-class DeviceRegistry:
-    devices : dict[str, DeviceMetric] = {}
+    def refill(self) -> None:
+        """Push every value again, even the unchanged ones"""
+        self._last_values.clear()
+        self.autofill()
+
+class DeviceRegistry:  # pylint: disable=too-many-instance-attributes
+    devices: dict[str, DeviceMetric]
     def __init__(self):
+        self.devices = {}
         self.registry = CollectorRegistry()
         self.devices_counter = Gauge('devices_counter', documentation='The total number of devices registered to the python script', registry=self.registry)
         self.devices_counter.set_function(lambda: len(self.devices))
 
         Info("dirigera_prometheus_gateway", __doc__.replace('\n', '').strip(), registry=self.registry)
         self.metric_export = Histogram('metric_export_seconds', 'Histogram of the metrics generation', registry=self.registry)
+        self.last_poll = Gauge('last_successful_poll_timestamp_seconds', 'Time of the last successful retrieval of the devices from the Dirigera hub', registry=self.registry)
+        self.poll_errors = Counter('poll_errors', 'Number of failed retrievals of the devices from the Dirigera hub', registry=self.registry)
+        self.failed_polls = 0
+        self.last_poll_time: typing.Optional[float] = None
+
+        # Devices which disappeared recently, kept to be reused if they come back
+        self.graveyard: collections.OrderedDict[str, DeviceMetric] = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.poll_interval = CONFIG.get('POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+        self.poller_pid = None
+        self.poller_lock = threading.Lock()
 
         self.hub = get_hub()
         self.update()
 
     def metric_factory(self) -> Callable:
         prometheus_display_metric = make_wsgi_app(self.registry)
-
-        def update_n_display(*args, **kwargs):
-            self.update()
-            return prometheus_display_metric(*args, **kwargs)
-
-        return self.metric_export.time()(
-            update_n_display
-        )
+        metric_export = self.metric_export
+
+        def display(environ, start_response):
+            self.start_polling()
+            if self.failed_polls >= MAX_FAILED_POLLS:
+                # Do not serve frozen values as if they were fresh, and let the healthcheck fail
+                start_response('503 Service Unavailable', [('Content-Type', 'text/plain; charset=utf-8')])
+                return [f'The last {self.failed_polls} retrievals from the Dirigera hub failed\n'.encode('utf-8')]
+            start = time.perf_counter()
+            try:
+                return prometheus_display_metric(environ, start_response)
+            finally:
+                metric_export.observe(time.perf_counter() - start)
+
+        return display
+
+    def start_polling(self) -> None:
+        """Start the thread polling the hub, if not already running in this process. Threads do not
+        survive a fork (e.g. gunicorn --preload), thus it is started lazily from the worker, which
+        first pushes the metric values again."""
+        pid = os.getpid()
+        if self.poller_pid == pid:
+            return
+        with self.poller_lock:
+            if self.poller_pid == pid:
+                return
+            self.refill()
+            threading.Thread(target=self.poll_loop, name='dirigera-poller', daemon=True).start()
+            self.poller_pid = pid
+
+    def poll_loop(self) -> None:
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.update()
+            except Exception:  # pylint: disable=broad-exception-caught
+                self.failed_polls += 1
+                self.poll_errors.inc()
+                logging.exception("Cannot update the metrics from the Dirigera hub (%d consecutive failures)",
+                                  self.failed_polls)
+            else:
+                self.failed_polls = 0
 
     def update(self):
         try:
@@ -337,22 +504,65 @@ class DeviceRegistry:
         except requests.exceptions.ConnectTimeout as exc:
             raise Exception("The Dirigera hub is not reachable") from exc
 
-        new_dev_id = set()
-        old_dev_id = list(self.devices.keys())
-        for dev in devs:
-            new_dev_id.add(dev.id)
-            if self.devices.get(dev.id) is None:
-                self.devices[dev.id] = DeviceMetric(dev, registry=self.registry)
-            else:
-                self.devices[dev.id].update(dev)
-
+        with self.lock:
+            self.apply(devs)
+        self.last_poll_time = time.time()
+        self.last_poll.set(self.last_poll_time)
+
+    def refill(self) -> None:
+        """With PROMETHEUS_MULTIPROC_DIR, the Gauge values live in per-process files, thus read 0 once
+        forked (e.g. gunicorn --preload), while the devices still skip their unchanged values. Push them
+        all again in the new process."""
+        with self.lock:
+            for metric in self.devices.values():
+                metric.refill()
+        if self.last_poll_time is not None:
+            self.last_poll.set(self.last_poll_time)
+
+    def apply(self, devs: list[dirigera.devices.device.Device]) -> None:
+        devices = self.devices
+        new_dev_id = {dev.id for dev in devs}
+        removed_dev_id = devices.keys() - new_dev_id
         logging.debug("new_dev_id=%r", new_dev_id)
-        logging.debug("old_dev_id=%r", old_dev_id)
-        for old_id in old_dev_id:
-            if old_id not in new_dev_id:
-                logging.debug("old_id=%s", old_id)
-                self.devices[old_id].unregister()
-                del self.devices[old_id]
+        logging.debug("removed_dev_id=%r", removed_dev_id)
+        # Removed first, to free their metrics names
+        for old_id in removed_dev_id:
+            metric = devices.pop(old_id)
+            metric.unregister()
+            self.graveyard[old_id] = metric
+            if len(self.graveyard) > GRAVEYARD_SIZE:
+                self.graveyard.popitem(last=False)
+
+        for dev in devs:
+            metric = devices.get(dev.id)
+            if metric is not None:
+                metric.update(dev)
+            elif self.revive(dev) is None:
+                devices[dev.id] = DeviceMetric(dev, registry=self.registry)
+
+    def revive(self, dev: dirigera.devices.device.Device) -> typing.Optional[DeviceMetric]:
+        """Reuse the metrics of a device which came back, if still in the graveyard"""
+        metric = self.graveyard.pop(dev.id, None)
+        if metric is None:
+            return None
+        try:
+            metric.register()
+        except ValueError:
+            logging.warning("Cannot reuse the metrics of the device %s, creating them again", dev.id)
+            return None
+        metric.update(dev)
+        self.devices[dev.id] = metric
+        return metric
+
+def positive_float(value: str) -> float:
+    """argparse type accepting only finite numbers greater than 0"""
+    try:
+        number = float(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f'{value!r} is not a number') from exc
+    if not math.isfinite(number) or number <= 0:
+        raise argparse.ArgumentTypeError(f'{value!r} is not a finite number greater than 0')
+    return number
 
 def main():
     """Parse CLI arguments and start the server"""
@@ -374,6 +584,12 @@ def main():
         help="If behind a reverse proxy, is the path to use to access this service.",
         default=""
     )
+    parser.add_argument(
+        "--poll-interval",
+        help="Delay, in seconds, between two retrievals of the devices states from the Dirigera hub",
+        type=positive_float,
+        default=DEFAULT_POLL_INTERVAL
+    )
     parser.add_argument("remote", help="Address of the Dirigera hub")
     parser.add_argument("hostname", help="The hostname that requests are supposed to use")
     parser.add_argument("token", help="The authentication token issued by the Dirigera hub")
@@ -392,6 +608,7 @@ def main():
     CONFIG['REMOTE_ADDR'] = args.remote
     CONFIG['HOSTNAME'] = args.hostname
     CONFIG['TOKEN'] = args.token
+    CONFIG['POLL_INTERVAL'] = args.poll_interval
 
     try:
         test_hub_params()
@@ -403,9 +620,15 @@ def main():
     webpath = args.webpath.replace('\\', '/')
     webpath = '/' + webpath.strip('/')
 
-    app = Flask(__name__)
+    # With subdomain matching, the URL map only matches requests made for SERVER_NAME. Requests
+    # using any other hostname get a 404 from the routing itself.
+    app = Flask(__name__, subdomain_matching=True)
+    app.config['SERVER_NAME'] = CONFIG['HOSTNAME']
     app.secret_key = secrets.token_hex()
     app.register_blueprint(bp, url_prefix=webpath)
+    # On the app, not the blueprint, so that the responses of requests not routed to the blueprint
+    # (e.g. wrong hostname) get them too
+    app.after_request(security_headers)
 
     logging.info("Listening on: %s://%s:%s%s", DEFAULT_PROTO, DEFAULT_ADDRESS, DEFAULT_PORT, webpath)
     if args.url is not None: